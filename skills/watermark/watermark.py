@@ -4,25 +4,54 @@
 Watermark Tool - 给 PDF、Word、Excel 文件添加水印
 """
 
+import functools
+import hashlib
+import json
+import logging
+import logging.handlers
+import multiprocessing
 import os
+import re
+import shutil
 import sys
 import argparse
+import threading
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from io import BytesIO
+from xml.sax.saxutils import escape, unescape
 
-# PDF 处理
+# PDF 处理：水印页用 reportlab 渲染，合并优先走 pikepdf（qpdf C++ 后端，
+# merge+写出比 PyPDF2 快数倍），没装 pikepdf 时回退 PyPDF2
 try:
-    from PyPDF2 import PdfReader, PdfWriter
     from reportlab.pdfgen import canvas
     from reportlab.pdfbase import pdfmetrics
     from reportlab.pdfbase.ttfonts import TTFont
-    PDF_SUPPORT = True
+    REPORTLAB_SUPPORT = True
+except ImportError:
+    REPORTLAB_SUPPORT = False
+
+try:
+    import pikepdf
+    PIKEPDF_SUPPORT = True
+except ImportError:
+    PIKEPDF_SUPPORT = False
+
+try:
+    from PyPDF2 import PdfReader, PdfWriter
+    PYPDF2_SUPPORT = True
 except ImportError:
-    PDF_SUPPORT = False
+    PYPDF2_SUPPORT = False
+
+PDF_SUPPORT = REPORTLAB_SUPPORT and (PIKEPDF_SUPPORT or PYPDF2_SUPPORT)
+
+log = logging.getLogger('watermark')
 
 # Word 处理
 try:
     from docx import Document
-    from docx.shared import Pt, RGBColor
+    from docx.oxml import parse_xml
+    from docx.oxml.ns import nsdecls
     DOCX_SUPPORT = True
 except ImportError:
     DOCX_SUPPORT = False
@@ -35,9 +64,10 @@ except ImportError:
     XLSX_SUPPORT = False
 
 
+@functools.lru_cache(maxsize=1)
 def register_chinese_font():
-    """注册中文字体"""
-    if not PDF_SUPPORT:
+    """注册中文字体（惰性执行并缓存，避免每次启动都扫字体路径、解析 TTF）"""
+    if not REPORTLAB_SUPPORT:
         return False
 
     font_paths = [
@@ -48,27 +78,103 @@ def register_chinese_font():
         "C:\\Windows\\Fonts\\msyh.ttc",
     ]
 
+    # 按目录分组，一次 scandir 代替逐个 os.path.exists 的 stat
+    font_dirs = {}
     for fp in font_paths:
-        if os.path.exists(fp):
-            try:
-                pdfmetrics.registerFont(TTFont('ChineseFont', fp))
-                return True
-            except:
-                continue
+        font_dirs.setdefault(os.path.dirname(fp), []).append(os.path.basename(fp))
+
+    for d, names in font_dirs.items():
+        try:
+            with os.scandir(d) as it:
+                present = {e.name for e in it}
+        except OSError:
+            continue
+        for name in names:
+            if name in present:
+                try:
+                    pdfmetrics.registerFont(TTFont('ChineseFont', os.path.join(d, name)))
+                    return True
+                except:
+                    continue
     return False
 
 
-FONT_REGISTERED = register_chinese_font() if PDF_SUPPORT else False
+# 三个水印锚点：中心、左上、右下（页面宽高的比例坐标）
+_WM_ANCHORS = ((0.5, 0.5), (0.25, 0.75), (0.75, 0.25))
+
+_TL = threading.local()
+
+
+def _scratch_buf():
+    """线程本地复用的 BytesIO：清空后返回，渲染水印不必每次新建缓冲"""
+    buf = getattr(_TL, 'buf', None)
+    if buf is None:
+        buf = _TL.buf = BytesIO()
+    buf.seek(0)
+    buf.truncate(0)
+    return buf
+
+
+def _create_watermark_pdf_raw(text, page_width, page_height):
+    """直接拼 PDF 内容流生成水印页，完全绕开 reportlab
+
+    三段旋转文字只需要几百字节的 PDF 操作符，不值得为此初始化一个
+    完整的 Canvas。仅限 Latin-1 文本（Helvetica 标准字体，无需嵌入）；
+    中文会抛 UnicodeEncodeError，由调用方回退 reportlab。
+    """
+    latin = text.encode('latin-1')
+    escaped = (latin.replace(b'\\', b'\\\\')
+                    .replace(b'(', b'\\(')
+                    .replace(b')', b'\\)'))
+    # Helvetica 平均字宽约 0.5em，近似居中
+    offset = -0.25 * 30 * len(text)
+
+    parts = [b'q /GS1 gs 0.7 0.7 0.7 rg']
+    for fx, fy in _WM_ANCHORS:
+        prefix = ('q 1 0 0 1 %.2f %.2f cm 0.7071 0.7071 -0.7071 0.7071 0 0 cm '
+                  'BT /F1 30 Tf %.2f 0 Td (' % (page_width * fx, page_height * fy,
+                                                offset)).encode('latin-1')
+        parts.append(prefix + escaped + b') Tj ET Q')
+    parts.append(b'Q')
+
+    pdf = pikepdf.new()
+    page = pdf.add_blank_page(page_size=(page_width, page_height))
+    font = pdf.make_indirect(pikepdf.Dictionary(
+        Type=pikepdf.Name.Font,
+        Subtype=pikepdf.Name.Type1,
+        BaseFont=pikepdf.Name.Helvetica,
+        # 默认的 StandardEncoding 在 0xA0-0xFF 区间和 Latin-1 对不上，
+        # 重音字符会画错字形；WinAnsi 在这段与 Latin-1 一致
+        Encoding=pikepdf.Name.WinAnsiEncoding,
+    ))
+    alpha = pdf.make_indirect(pikepdf.Dictionary(
+        Type=pikepdf.Name.ExtGState, ca=0.3, CA=0.3))
+    page.Resources = pikepdf.Dictionary(
+        Font=pikepdf.Dictionary(F1=font),
+        ExtGState=pikepdf.Dictionary(GS1=alpha),
+    )
+    page.Contents = pdf.make_stream(b' '.join(parts))
+
+    buf = _scratch_buf()
+    pdf.save(buf)
+    return buf.getvalue()
 
 
 def create_watermark_pdf(text, page_width, page_height):
-    """创建水印 PDF"""
-    packet = BytesIO()
+    """创建水印 PDF，返回序列化后的 PDF 字节"""
+    if PIKEPDF_SUPPORT:
+        try:
+            return _create_watermark_pdf_raw(text, page_width, page_height)
+        except UnicodeEncodeError:
+            # 非 Latin-1 文本需要嵌入中文字体，走 reportlab
+            pass
+
+    packet = _scratch_buf()
     c = canvas.Canvas(packet, pagesize=(page_width, page_height))
 
     c.setFillColorRGB(0.7, 0.7, 0.7, alpha=0.3)
 
-    if FONT_REGISTERED:
+    if register_chinese_font():
         c.setFont('ChineseFont', 30)
     else:
         c.setFont('Helvetica', 30)
@@ -95,158 +201,573 @@ def create_watermark_pdf(text, page_width, page_height):
     c.restoreState()
 
     c.save()
-    packet.seek(0)
-    return PdfReader(packet)
+    return packet.getvalue()
 
 
-def add_watermark_pdf(input_path, output_path, text):
-    """给 PDF 添加水印"""
-    if not PDF_SUPPORT:
-        print("错误: 需要安装 PyPDF2 和 reportlab")
-        print("运行: pip install PyPDF2 reportlab")
-        return False
+# 水印页缓存：同一文档里页面尺寸几乎都相同，不必每页重新渲染
+_WM_CACHE = {}
+
 
+def _add_watermark_pdf_pikepdf(input_path, output_path, text):
+    """pikepdf 路径：merge 和写出都在 qpdf 原生代码里完成"""
+    # 与 xlsx/docx 路径相同的临时文件 + 原子换入：qpdf 拒绝把输出直接
+    # 写回输入文件（-o 指回源目录时 output 和 input 是同一个文件）
+    tmp_path = output_path + '.ptmp'
+    try:
+        with pikepdf.open(input_path) as pdf:
+            # 每种页面尺寸只解析一次水印字节，stamp 文档在写出后统一关闭
+            stamps = {}
+            try:
+                for page in pdf.pages:
+                    box = page.mediabox
+                    page_width = float(box[2]) - float(box[0])
+                    page_height = float(box[3]) - float(box[1])
+                    key = (round(page_width, 1), round(page_height, 1))
+                    if key not in stamps:
+                        wm_bytes = create_watermark_pdf(text, page_width, page_height)
+                        stamps[key] = pikepdf.open(BytesIO(wm_bytes))
+                    page.add_overlay(stamps[key].pages[0])
+                # 保留原有对象流、不解码重压缩未改动的流：大 PDF 的写出时间
+                # 主要花在重新序列化没变的对象上
+                pdf.save(tmp_path,
+                         linearize=False,
+                         object_stream_mode=pikepdf.ObjectStreamMode.preserve,
+                         compress_streams=False,
+                         stream_decode_level=pikepdf.StreamDecodeLevel.none)
+            finally:
+                for stamp in stamps.values():
+                    stamp.close()
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+    os.replace(tmp_path, output_path)
+
+
+def _wm_page_for(page, text):
+    """取出（必要时渲染并缓存）与该页尺寸匹配的水印页"""
+    page_width = float(page.mediabox.width)
+    page_height = float(page.mediabox.height)
+    key = (round(page_width, 1), round(page_height, 1), text)
+    if key not in _WM_CACHE:
+        wm_bytes = create_watermark_pdf(text, page_width, page_height)
+        _WM_CACHE[key] = PdfReader(BytesIO(wm_bytes)).pages[0]
+    return _WM_CACHE[key]
+
+
+def _add_watermark_pdf_pypdf2(input_path, output_path, text):
+    """PyPDF2 回退路径
+
+    页级并行在这里行不通：页对象的 /Contents 和资源是通过 reader 共享的
+    底层流延迟 seek/read 解析的，多线程 merge_page 会在同一个流上竞争。
+    """
     try:
         reader = PdfReader(input_path)
         writer = PdfWriter()
 
         for page in reader.pages:
-            page_width = float(page.mediabox.width)
-            page_height = float(page.mediabox.height)
-            watermark = create_watermark_pdf(text, page_width, page_height)
-            page.merge_page(watermark.pages[0])
+            page.merge_page(_wm_page_for(page, text))
             writer.add_page(page)
 
         with open(output_path, 'wb') as f:
             writer.write(f)
+    finally:
+        _WM_CACHE.clear()
+
+
+def add_watermark_pdf(input_path, output_path, text):
+    """给 PDF 添加水印"""
+    if not PDF_SUPPORT:
+        log.error("错误: 需要安装 pikepdf（或 PyPDF2）和 reportlab")
+        log.error("运行: pip install pikepdf reportlab")
+        return False
+
+    try:
+        if PIKEPDF_SUPPORT:
+            _add_watermark_pdf_pikepdf(input_path, output_path, text)
+        else:
+            _add_watermark_pdf_pypdf2(input_path, output_path, text)
         return True
     except Exception as e:
-        print(f"PDF 处理失败: {e}")
+        log.error(f"PDF 处理失败: {e}")
         return False
 
 
+@functools.lru_cache(maxsize=8)
+def _docx_run_xml(text):
+    """预拼水印 <w:r>：36pt（sz 单位是半磅）、C8C8C8 灰
+
+    同一批文件的 run XML 完全相同，拼一次字符串缓存起来，
+    绕开 python-docx 逐属性 setter（Pt/RGBColor 每次都要查找 XML 元素）。
+    """
+    return ('<w:r %s><w:rPr><w:sz w:val="72"/><w:szCs w:val="72"/>'
+            '<w:color w:val="C8C8C8"/></w:rPr>'
+            '<w:t xml:space="preserve">%s</w:t></w:r>'
+            % (nsdecls('w'), escape(text)))
+
+
+_DOCX_HEADER_XML = re.compile(r'^word/header\d+\.xml$')
+
+
+def _docx_header_para(text):
+    """注入到 header XML 的 <w:p>：居中，run 样式与 python-docx 路径一致"""
+    return ('<w:p><w:pPr><w:jc w:val="center"/></w:pPr>'
+            '<w:r><w:rPr><w:sz w:val="72"/><w:szCs w:val="72"/>'
+            '<w:color w:val="C8C8C8"/></w:rPr>'
+            '<w:t xml:space="preserve">%s</w:t></w:r></w:p>'
+            % escape(text)).encode('utf-8')
+
+
+def _add_watermark_docx_zip(input_path, output_path, text):
+    """流式改写路径：直接往 word/header*.xml 注入水印段落，不解析文档
+
+    与 xlsx 同理：python-docx 会把样式、编号、正文段落全部实例化，而
+    水印只动页眉。返回 False 表示文档没有现成的 header part（此时需要
+    python-docx 去创建 header 及 rels/Content_Types 关系项）。
+    """
+    para = _docx_header_para(text)
+
+    # 与 xlsx 路径相同：先写临时文件再原子换入，避免 output 与 input
+    # 是同一文件时 'w' 模式截空正在读的源文件
+    tmp_path = output_path + '.ztmp'
+    try:
+        with zipfile.ZipFile(input_path) as zin:
+            if not any(_DOCX_HEADER_XML.match(n) for n in zin.namelist()):
+                return False
+            with zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_DEFLATED) as zout:
+                for info in zin.infolist():
+                    data = zin.read(info)
+                    if _DOCX_HEADER_XML.match(info.filename):
+                        data = data.replace(b'</w:hdr>', para + b'</w:hdr>', 1)
+                    zout.writestr(info, data)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+    os.replace(tmp_path, output_path)
+    return True
+
+
 def add_watermark_docx(input_path, output_path, text):
     """给 Word 添加水印"""
+    try:
+        if _add_watermark_docx_zip(input_path, output_path, text):
+            return True
+    except Exception as e:
+        if not DOCX_SUPPORT:
+            log.error(f"Word 处理失败: {e}")
+            return False
+
+    # 模板没有 header part（或 zip 改写失败），回退 python-docx 完整解析
     if not DOCX_SUPPORT:
-        print("错误: 需要安装 python-docx")
-        print("运行: pip install python-docx")
+        log.error("错误: 需要安装 python-docx")
+        log.error("运行: pip install python-docx")
         return False
 
     try:
         doc = Document(input_path)
+        run_xml = _docx_run_xml(text)
 
         for section in doc.sections:
             header = section.header
             p = header.paragraphs[0] if header.paragraphs else header.add_paragraph()
-            run = p.add_run(text)
-            run.font.size = Pt(36)
-            run.font.color.rgb = RGBColor(200, 200, 200)
+            p._p.append(parse_xml(run_xml))
             p.alignment = 1
 
         doc.save(output_path)
         return True
     except Exception as e:
-        print(f"Word 处理失败: {e}")
+        log.error(f"Word 处理失败: {e}")
         return False
 
 
+_SHEET_XML = re.compile(r'^xl/worksheets/[^/]+\.xml$')
+_HEADER_FOOTER = re.compile(
+    rb'<headerFooter\b[^>]*/>|<headerFooter\b.*?</headerFooter>', re.DOTALL)
+_ODD_HEADER = re.compile(rb'<oddHeader/>|<oddHeader\b.*?</oddHeader>', re.DOTALL)
+_EVEN_HEADER = re.compile(rb'<evenHeader/>|<evenHeader\b.*?</evenHeader>', re.DOTALL)
+# CT_HeaderFooter 的子元素序列里 evenHeader 必须排在这些元素之前
+_AFTER_EVEN_HEADER = re.compile(rb'<(?:evenFooter|firstHeader|firstFooter)\b')
+# 页眉字符串的 &L/&C/&R 段标记（与 openpyxl 相同的切分方式）
+_HF_SECTION = re.compile(r'(&[LCR])')
+
+
+def _xlsx_header_center(text):
+    """&C 段内容：&24 字号、&K 颜色（页眉语法里字面 & 要双写）"""
+    return '&24&KC0C0C0' + text.replace('&', '&&')
+
+
+def _merge_header_value(value, center):
+    """替换页眉字符串的 &C 段，保留已有的 &L/&R 段"""
+    sections = {}
+    current = 'C'  # 无段标记的前缀按居中处理（Excel 的默认段）
+    for token in _HF_SECTION.split(value):
+        if token in ('&L', '&C', '&R'):
+            current = token[1]
+            sections.setdefault(current, '')
+        elif token:
+            sections[current] = sections.get(current, '') + token
+    sections['C'] = center
+    return ''.join('&%s%s' % (k, sections[k]) for k in 'LCR' if k in sections)
+
+
+def _patch_sheet_header(data, center):
+    """只改写 odd/evenHeader 的 &C 段，保留 headerFooter 的属性
+    （differentFirst 等）、footer 子元素和左右页眉段，行为与 openpyxl
+    回退路径一致。替换一律走 lambda，免得水印文字里的反斜杠被当转义解释。
+    """
+    fresh = escape(_merge_header_value('', center)).encode('utf-8')
+    odd = b'<oddHeader>' + fresh + b'</oddHeader>'
+    even = b'<evenHeader>' + fresh + b'</evenHeader>'
+
+    def _patch_elem(m_elem, tag):
+        elem = m_elem.group(0)
+        if elem.endswith(b'/>'):
+            inner = b''
+        else:
+            inner = elem[elem.index(b'>') + 1:-(len(tag) + 3)]
+        merged = _merge_header_value(unescape(inner.decode('utf-8')), center)
+        return b'<%s>%s</%s>' % (tag.encode('ascii'),
+                                 escape(merged).encode('utf-8'),
+                                 tag.encode('ascii'))
+
+    m = _HEADER_FOOTER.search(data)
+    if m is None:
+        hf = b'<headerFooter>' + odd + even + b'</headerFooter>'
+        # schema 要求 headerFooter 紧跟 pageSetup/pageMargins，
+        # 插错位置 Excel 打开时会提示修复
+        pos = (re.search(rb'<pageSetup\b[^>]*/>', data)
+               or re.search(rb'<pageMargins\b[^>]*/>', data))
+        if pos:
+            return data[:pos.end()] + hf + data[pos.end():]
+        return data.replace(b'</worksheet>', hf + b'</worksheet>', 1)
+
+    elem = m.group(0)
+    if elem.endswith(b'/>'):
+        # 自闭合元素：展开成带子元素的形式，属性原样保留
+        new = elem[:-2] + b'>' + odd + even + b'</headerFooter>'
+    else:
+        open_end = elem.index(b'>') + 1
+        body = elem[open_end:-len(b'</headerFooter>')]
+        body, n = _ODD_HEADER.subn(lambda m2: _patch_elem(m2, 'oddHeader'),
+                                   body, count=1)
+        if not n:
+            body = odd + body  # oddHeader 是序列里的第一个子元素
+        body, n = _EVEN_HEADER.subn(lambda m2: _patch_elem(m2, 'evenHeader'),
+                                    body, count=1)
+        if not n:
+            m2 = _AFTER_EVEN_HEADER.search(body)
+            pos = m2.start() if m2 else len(body)
+            body = body[:pos] + even + body[pos:]
+        new = elem[:open_end] + body + b'</headerFooter>'
+    return data[:m.start()] + new + data[m.end():]
+
+
+def _add_watermark_xlsx_zip(input_path, output_path, text):
+    """流式改写路径：只 patch 各 sheet XML 里的 headerFooter，不解析单元格
+
+    openpyxl 的 load_workbook 会把整本工作簿的单元格都实例化（内存约为
+    文件大小的 50 倍），而我们只改页眉。直接在 zip 层替换字节，内存恒定。
+    """
+    center = _xlsx_header_center(text)
+
+    # 先写同目录临时文件、成功后原子换入：output 与 input 指向同一文件时
+    # （如 -o 指回源目录），直接以 'w' 打开会把正在读的源文件截空
+    tmp_path = output_path + '.ztmp'
+    try:
+        with zipfile.ZipFile(input_path) as zin, \
+             zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_DEFLATED) as zout:
+            for info in zin.infolist():
+                data = zin.read(info)
+                if _SHEET_XML.match(info.filename):
+                    data = _patch_sheet_header(data, center)
+                zout.writestr(info, data)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+    os.replace(tmp_path, output_path)
+
+
+def _add_watermark_xlsx_openpyxl(input_path, output_path, text):
+    """openpyxl 回退路径"""
+    # keep_links=False 避免 openpyxl 去解析外部链接缓存的工作表；
+    # 按 sheetname 懒加载，不提前碰 wb.worksheets
+    wb = load_workbook(input_path, keep_vba=False, keep_links=False)
+
+    for name in wb.sheetnames:
+        sheet = wb[name]
+        sheet.oddHeader.center.text = text
+        sheet.oddHeader.center.size = 24
+        sheet.oddHeader.center.color = "C0C0C0"
+        sheet.evenHeader.center.text = text
+        sheet.evenHeader.center.size = 24
+        sheet.evenHeader.center.color = "C0C0C0"
+
+    wb.save(output_path)
+
+
 def add_watermark_xlsx(input_path, output_path, text):
     """给 Excel 添加水印"""
-    if not XLSX_SUPPORT:
-        print("错误: 需要安装 openpyxl")
-        print("运行: pip install openpyxl")
+    try:
+        _add_watermark_xlsx_zip(input_path, output_path, text)
+        return True
+    except Exception as e:
+        if not XLSX_SUPPORT:
+            log.error(f"Excel 处理失败: {e}")
+            return False
+
+    # zip 改写失败（文件结构异常等），回退 openpyxl 完整解析
+    try:
+        _add_watermark_xlsx_openpyxl(input_path, output_path, text)
+        return True
+    except Exception as e:
+        log.error(f"Excel 处理失败: {e}")
         return False
 
+
+# 扩展名 → 处理函数，单点定义支持的文件类型
+HANDLERS = {
+    '.pdf': add_watermark_pdf,
+    '.docx': add_watermark_docx,
+    '.xlsx': add_watermark_xlsx,
+}
+
+# 预编译的目录遍历过滤器：隐藏/Office 临时文件，以及由 HANDLERS 生成的
+# 扩展名匹配 —— 每个目录项一次 C 级正则，代替多个 startswith/rpartition
+_SKIP_NAME = re.compile(r'^(?:\.|~\$)').match
+_EXT_MATCH = re.compile(
+    '(?:%s)$' % '|'.join(re.escape(ext) for ext in HANDLERS),
+    re.IGNORECASE).search
+
+
+# 跨次运行的产物缓存：同一文件 + 同一水印文字的结果直接硬链接复用，
+# CI / 文档流水线反复跑同一目录时可以整文件跳过。
+# _CACHE_VERSION 在输出格式变化时递增，让旧缓存自动失效
+_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'watermark')
+_CACHE_INDEX = os.path.join(_CACHE_DIR, 'index.json')
+_CACHE_VERSION = '1'
+
+
+def _cache_key(file_path, text):
+    """blake2b(文件内容 + 水印文字 + 缓存版本)；读失败返回 None"""
+    try:
+        h = hashlib.blake2b(digest_size=20)
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        h.update(text.encode('utf-8'))
+        h.update(_CACHE_VERSION.encode('ascii'))
+        return h.hexdigest()
+    except OSError:
+        return None
+
+
+def _cache_load_index():
     try:
-        wb = load_workbook(input_path)
+        with open(_CACHE_INDEX, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
 
-        for sheet in wb.worksheets:
-            sheet.oddHeader.center.text = text
-            sheet.oddHeader.center.size = 24
-            sheet.oddHeader.center.color = "C0C0C0"
-            sheet.evenHeader.center.text = text
-            sheet.evenHeader.center.size = 24
-            sheet.evenHeader.center.color = "C0C0C0"
 
-        wb.save(output_path)
+def _cache_fetch(key, output_path):
+    """命中则把缓存产物硬链接（跨设备时复制）到 output_path"""
+    name = _cache_load_index().get(key)
+    if not name:
+        return False
+    src = os.path.join(_CACHE_DIR, name)
+    try:
+        if os.path.exists(output_path):
+            os.unlink(output_path)
+        try:
+            os.link(src, output_path)
+        except OSError:
+            shutil.copy2(src, output_path)
         return True
-    except Exception as e:
-        print(f"Excel 处理失败: {e}")
+    except OSError:
         return False
 
 
+def _cache_store(key, output_path):
+    """把产物链接进缓存目录并更新索引；缓存写失败不影响主流程。
+
+    并行 worker 各自读改写索引，最后写入者胜出 —— 丢的只是一条缓存记录，
+    下次重跑会补上，不值得为此上锁。
+    """
+    try:
+        os.makedirs(_CACHE_DIR, exist_ok=True)
+        name = key + os.path.splitext(output_path)[1]
+        dst = os.path.join(_CACHE_DIR, name)
+        if not os.path.exists(dst):
+            try:
+                os.link(output_path, dst)
+            except OSError:
+                shutil.copy2(output_path, dst)
+        index = _cache_load_index()
+        index[key] = name
+        tmp = '%s.%d.tmp' % (_CACHE_INDEX, os.getpid())
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(index, f)
+        os.replace(tmp, _CACHE_INDEX)
+    except OSError:
+        pass
+
+
 def process_file(file_path, text, output_dir=None, overwrite=False):
     """处理单个文件"""
     ext = os.path.splitext(file_path)[1].lower()
+    handler = HANDLERS.get(ext)
+    if handler is None:
+        log.error(f"不支持的文件类型: {ext}")
+        return False
 
+    tmp_path = None
     if output_dir:
         os.makedirs(output_dir, exist_ok=True)
         output_path = os.path.join(output_dir, os.path.basename(file_path))
     elif overwrite:
-        output_path = file_path
-        # 先备份
-        temp_path = file_path + ".tmp"
-        os.rename(file_path, temp_path)
-        file_path = temp_path
+        # 写到同目录临时文件，成功后 os.replace 原子换入，
+        # 任何时刻原文件要么完整存在、要么已被完整替换
+        tmp_path = file_path + ".wmtmp"
+        output_path = tmp_path
     else:
         base, extension = os.path.splitext(file_path)
         output_path = f"{base}_watermarked{extension}"
 
-    success = False
-
-    if ext == '.pdf':
-        success = add_watermark_pdf(file_path, output_path, text)
-    elif ext == '.docx':
-        success = add_watermark_docx(file_path, output_path, text)
-    elif ext == '.xlsx':
-        success = add_watermark_xlsx(file_path, output_path, text)
+    key = _cache_key(file_path, text)
+    if key and _cache_fetch(key, output_path):
+        success = True
     else:
-        print(f"不支持的文件类型: {ext}")
-        return False
+        success = handler(file_path, output_path, text)
+        if success and key:
+            _cache_store(key, output_path)
 
-    # 清理临时文件
-    if overwrite and not output_dir:
+    if tmp_path is not None:
         if success:
-            os.remove(file_path)
+            os.replace(tmp_path, file_path)
         else:
-            os.rename(file_path, output_path.replace(".tmp", ""))
+            try:
+                os.unlink(tmp_path)
+            except FileNotFoundError:
+                pass
 
     return success
 
 
-def process_directory(dir_path, text, output_dir=None, overwrite=False):
-    """处理目录中的所有文件"""
-    supported_exts = {'.pdf', '.docx', '.xlsx'}
-    results = {'success': 0, 'failed': 0}
+def _init_worker(log_queue=None):
+    """工作进程初始化：日志走队列发回父进程，TTF 每个进程只解析一次"""
+    if log_queue is not None:
+        root = logging.getLogger()
+        root.handlers[:] = [logging.handlers.QueueHandler(log_queue)]
+        root.setLevel(logging.INFO)
+    if REPORTLAB_SUPPORT:
+        register_chinese_font()
 
-    for root, dirs, files in os.walk(dir_path):
-        # 跳过隐藏目录
-        dirs[:] = [d for d in dirs if not d.startswith('.')]
 
-        for f in files:
-            if f.startswith('~$') or f.startswith('.'):
-                continue
+def _process_one(task):
+    """工作进程入口：解包任务并调用 process_file（模块级函数才能被 pickle）"""
+    file_path, text, file_output_dir, overwrite = task
+    return process_file(file_path, text, file_output_dir, overwrite)
+
+
+def default_jobs():
+    """默认并行数：留一个核给系统，单核机器退化为串行"""
+    return max((os.cpu_count() or 1) - 1, 1)
+
 
-            ext = os.path.splitext(f)[1].lower()
-            if ext not in supported_exts:
+def _iter_files(dir_path):
+    """递归 scandir 遍历：DirEntry 的 name/is_file 直接来自 readdir 批量结果，
+    比 os.walk + 逐项 stat/splitext 少一轮系统调用；隐藏目录和临时文件在此跳过"""
+    subdirs = []
+    with os.scandir(dir_path) as it:
+        for entry in it:
+            if _SKIP_NAME(entry.name):
                 continue
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+            elif entry.is_file():
+                yield entry
+    for sub in subdirs:
+        yield from _iter_files(sub)
 
-            file_path = os.path.join(root, f)
 
-            # 计算输出目录（保持目录结构）
-            if output_dir:
-                rel_path = os.path.relpath(root, dir_path)
-                file_output_dir = os.path.join(output_dir, rel_path)
-            else:
-                file_output_dir = None
+def process_directory(dir_path, text, output_dir=None, overwrite=False, jobs=None):
+    """处理目录中的所有文件，jobs > 1 时用进程池并行处理"""
+    results = {'success': 0, 'failed': 0}
+    tasks = []
+
+    for entry in _iter_files(dir_path):
+        if not _EXT_MATCH(entry.name):
+            continue
+
+        file_path = entry.path
+
+        # 计算输出目录（保持目录结构）
+        if output_dir:
+            rel_path = os.path.relpath(os.path.dirname(file_path), dir_path)
+            file_output_dir = os.path.join(output_dir, rel_path)
+        else:
+            file_output_dir = None
 
-            print(f"处理: {f}")
-            if process_file(file_path, text, file_output_dir, overwrite):
-                print(f"  ✓ 完成")
+        tasks.append((file_path, text, file_output_dir, overwrite))
+
+    if jobs is None:
+        jobs = default_jobs()
+
+    if jobs <= 1:
+        # 串行路径：机械硬盘上并发读取反而更慢
+        for task in tasks:
+            log.info(f"处理: {os.path.basename(task[0])}")
+            if _process_one(task):
+                log.info("  ✓ 完成")
                 results['success'] += 1
             else:
-                print(f"  ✗ 失败")
+                log.info("  ✗ 失败")
                 results['failed'] += 1
+    else:
+        # 大文件先派发（LPT 启发式）：总耗时取决于最慢 worker 的收尾，
+        # 别让最大的 PDF 落在最后一个空闲 worker 上拖长尾
+        def _task_size(task):
+            try:
+                return os.stat(task[0]).st_size
+            except OSError:
+                return 0
+
+        tasks.sort(key=_task_size, reverse=True)
+
+        # submit + as_completed：完成一个算一个，慢文件不会卡住其它结果，
+        # 各 worker 的读写和渲染自然交错；worker 日志经队列汇到父进程输出，
+        # 避免多进程抢 stdout
+        log_queue = multiprocessing.Queue()
+        handlers = logging.getLogger().handlers or [logging.StreamHandler()]
+        listener = logging.handlers.QueueListener(log_queue, *handlers)
+        listener.start()
+        try:
+            with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                                     initargs=(log_queue,)) as pool:
+                futures = {pool.submit(_process_one, task): task for task in tasks}
+                for fut in as_completed(futures):
+                    task = futures[fut]
+                    try:
+                        ok = fut.result()
+                    except Exception as e:
+                        log.error(f"处理异常: {task[0]}: {e}")
+                        ok = False
+                    if ok:
+                        log.info(f"✓ {os.path.basename(task[0])}")
+                        results['success'] += 1
+                    else:
+                        log.info(f"✗ {os.path.basename(task[0])}")
+                        results['failed'] += 1
+        finally:
+            listener.stop()
 
     return results
 
@@ -269,9 +790,13 @@ def main():
     parser.add_argument('-d', '--directory', help='处理整个目录')
     parser.add_argument('-o', '--output', help='输出目录')
     parser.add_argument('--overwrite', action='store_true', help='覆盖原文件')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='并行进程数（默认 CPU 核数减一，1 表示串行）')
 
     args = parser.parse_args()
 
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
     if args.directory:
         target = args.directory
     elif args.path:
@@ -291,7 +816,8 @@ def main():
             print("✗ 水印添加失败")
             sys.exit(1)
     else:
-        results = process_directory(target, args.text, args.output, args.overwrite)
+        results = process_directory(target, args.text, args.output, args.overwrite,
+                                    jobs=args.jobs)
         print(f"\n完成: {results['success']} 成功, {results['failed']} 失败")
 
 